@@ -6,6 +6,8 @@ import numpy as np
 import scipy.stats
 spec = importlib.util.spec_from_file_location("opine", "opine.py")
 opinedb = importlib.util.module_from_spec(spec)
+# registered so that its functions can be sent to worker processes
+sys.modules["opine"] = opinedb
 spec.loader.exec_module(opinedb)
 
 from gensim.models import Word2Vec
@@ -1,23 +1,90 @@
 import json
 import csv
 import sys
+import os
+import pickle
+import hashlib
 import random
 import math
+import itertools
 import time
 import numpy as np
 import importlib.util
 
+from concurrent.futures import ProcessPoolExecutor
+
 spec = importlib.util.spec_from_file_location("opine", "opine.py")
 opinedb = importlib.util.module_from_spec(spec)
+# registered so that its functions can be sent to worker processes
+sys.modules["opine"] = opinedb
 spec.loader.exec_module(opinedb)
 # from opine import SimpleOpine
 
 
 def generate_queries(query_terms, n=100, k=3):
-    results = []
-    for i in range(n):
-        results.append(random.choices(query_terms, k=k))
-    return results
+    # draw the term indices of all n queries in a single call
+    term_ids = np.random.randint(len(query_terms), size=(n, k))
+    return [[query_terms[i] for i in row] for row in term_ids]
+
+
+def entity_matrix(entities, attributes):
+    """
+    Stack the numeric attributes of all entities into a dense matrix.
+
+    Args:
+        entities (Dict): a dictionary from business_id to entities
+        attributes (List of str): the attributes to be stacked as columns
+    Returns:
+        np.array: the array of bids (one per row)
+        np.array: a matrix of shape (num_entities, num_attributes)
+    """
+    bid_array = np.array(list(entities.keys()))
+    M = np.asarray([[entities[bid][attr] for attr in attributes] for bid in bid_array],
+                   dtype=np.float64)
+    return bid_array, M
+
+
+def top_k(bid_array, values, k=10):
+    """
+    Return the k bids with the highest values. Ties are broken by the position
+    in bid_array, i.e., the result is the same as that of a stable sort.
+
+    Args:
+        bid_array (np.array): the array of bids
+        values (np.array): the value of each bid
+        k (int): the number of bids to return
+    Returns:
+        List of str: the top-k bids
+    """
+    if len(values) > k:
+        threshold = np.partition(-values, k - 1)[k - 1]
+        idx = np.flatnonzero(-values <= threshold)
+    else:
+        idx = np.arange(len(values))
+    idx = idx[np.argsort(-values[idx], kind='stable')][:k]
+    return bid_array[idx].tolist()
+
+
+def expand_pairs(list_size1, pair_lists):
+    """
+    Expand the ranklists of the unordered attribute pairs to all ordered
+    pairs (attr1, attr2). The pairwise rankings are symmetric, and ranking by
+    the pair (attr, attr) is the same as ranking by attr alone.
+
+    Args:
+        list_size1 (List): the ranklist of each single attribute
+        pair_lists (Dict): the ranklist of each pair (j1, j2) with j1 < j2
+    Returns:
+        List: the ranklists of all attribute pairs in row-major order
+    """
+    list_size2 = []
+    for j1 in range(len(list_size1)):
+        for j2 in range(len(list_size1)):
+            if j1 == j2:
+                list_size2.append(list_size1[j1])
+            else:
+                list_size2.append(pair_lists[(min(j1, j2), max(j1, j2))])
+    return list_size2
 
 
 def AB_baseline_hotel(entities):
@@ -30,18 +97,19 @@ def AB_baseline_hotel(entities):
     rank_rating_attr2 = 'Overall Rating'
 
     attributes = ab_attributes
-    bids = list(entities.keys())
-    list1 = sorted(bids, key=lambda x : -entities[x][rank_rating_attr1])[:10]
-    list2 = sorted(bids, key=lambda x : -entities[x][rank_rating_attr2])[:10]
+    bid_array, M = entity_matrix(entities, [rank_rating_attr1, rank_rating_attr2] + attributes)
+    list1 = top_k(bid_array, M[:, 0])
+    list2 = top_k(bid_array, M[:, 1])
 
+    M = M[:, 2:]
     list_size1 = []
-    for attr in attributes:
-        list_size1.append(sorted(bids, key=lambda x : -entities[x][attr])[:10])
+    for j in range(len(attributes)):
+        list_size1.append(top_k(bid_array, M[:, j]))
 
-    list_size2 = []
-    for attr1 in attributes:
-        for attr2 in attributes:
-            list_size2.append(sorted(bids, key=lambda x : -entities[x][attr1]-entities[x][attr2])[:10])
+    pair_lists = {}
+    for (j1, j2) in itertools.combinations(range(len(attributes)), 2):
+        pair_lists[(j1, j2)] = top_k(bid_array, M[:, j1] + M[:, j2])
+    list_size2 = expand_pairs(list_size1, pair_lists)
 
     return [[list1], [list2], list_size1, list_size2]
 
@@ -52,95 +120,101 @@ def AB_baseline_restaurant(entities):
     rank_rating_attr2 = 'review_count'
 
     attributes = ab_attributes
-    bids = list(entities.keys())
-    list1 = sorted(bids, key=lambda x : -entities[x][rank_rating_attr1])[:10]
-    list2 = sorted(bids, key=lambda x : -entities[x][rank_rating_attr2])[:10]
+    bid_array, M = entity_matrix(entities, [rank_rating_attr1, rank_rating_attr2])
+    present = np.array([[attr in entities[bid] for attr in attributes] for bid in bid_array],
+                       dtype=bool).reshape(len(bid_array), len(attributes))
+    list1 = top_k(bid_array, M[:, 0])
+    list2 = top_k(bid_array, M[:, 1])
 
     list_size1 = []
-    for attr in attributes:
-        sub_bids = [bid for bid in bids if attr in entities[bid]]
-        list_size1.append(sorted(sub_bids, key=lambda x : -entities[x][rank_rating_attr1])[:10])
+    for j in range(len(attributes)):
+        mask = present[:, j]
+        list_size1.append(top_k(bid_array[mask], M[mask, 0]))
 
-    list_size2 = []
-    for attr1 in attributes:
-        for attr2 in attributes:
-            sub_bids = [bid for bid in bids if attr1 in entities[bid] and attr2 in entities[bid]]
-            list_size2.append(sorted(sub_bids, key=lambda x : -entities[x][rank_rating_attr1])[:10])
+    pair_lists = {}
+    for (j1, j2) in itertools.combinations(range(len(attributes)), 2):
+        mask = present[:, j1] & present[:, j2]
+        pair_lists[(j1, j2)] = top_k(bid_array[mask], M[mask, 0])
+    list_size2 = expand_pairs(list_size1, pair_lists)
 
     return [[list1], [list2], list_size1, list_size2]
 
 
 
-def IR_baseline(entities, queries, entity_type='hotel'):
-
-    rank_rating_attr2 = 'review_count' if entity_type == 'restaurant' else 'Overall Rating'
-
-    from gensim.summarization.bm25 import get_bm25_weights, BM25
+def corpus_cache_path(*fns, cache_dir='cache'):
+    """
+    Name the cache file of the tokenized IR corpus after the input files'
+    paths and modification times, so that the cache is invalidated whenever
+    one of the inputs changes.
+
+    Args:
+        fns (List of str): the entity and review files the corpus depends on
+        cache_dir (str): the directory of the cache files
+    Returns:
+        str: the path of the cache file
+    """
+    key = hashlib.sha1()
+    for fn in fns:
+        key.update(('%s:%f;' % (fn, os.path.getmtime(fn))).encode())
+    return os.path.join(cache_dir, 'ir_corpus_%s.pkl' % key.hexdigest())
+
+
+def build_index(hotels, cache_fn=None):
+    """
+    Build the BM25 index of the IR baseline over the concatenated reviews of
+    each entity. The index does not depend on the queries, so it is built once
+    and shared by all query sets.
+
+    Args:
+        hotels (Dict): a dictionary from business_id to entities
+        cache_fn (str): if given, the tokenized reviews are loaded from (or
+            saved to) this pickle file
+    Returns:
+        SparseBM25: the bm25 index (one document per entity, in the order of hotels)
+    """
     import gensim
 
-    def build_index(hotels):
-        # build bm25 model
+    if cache_fn != None and os.path.exists(cache_fn):
+        with open(cache_fn, 'rb') as fin:
+            tokens = pickle.load(fin)
+    else:
+        tokens = {}
         for hname in hotels:
-            hotels[hname]['combined_review'] = ''
+            combined_review = ''
             for rid in hotels[hname]['reviews']:
                 if 'text' in reviews[rid]:
                     review = reviews[rid]['text'].strip()
                 else:
                     review = reviews[rid]['review'].strip()
-                hotels[hname]['combined_review'] += ' ' + review
-
-        # build bm25 index
-        corpus = [gensim.utils.simple_preprocess(hotels[h]['combined_review']) for h in hotels]
-        bm25 = BM25(corpus)
-        return bm25
-
-    def baseline(query, hotels, merged_query=True, num_synonyms=0):
-        result = []
-        bm25_scores = []
-
-        if merged_query:
-            qterms = []
-            for qterm in query:
-                qterm = qterm.lower()
-                for q in qterm.split(' '):
-                    qterms += [q]
-                    if num_synonyms > 0 and q in model.wv:
-                        for (w, score) in model.wv.most_similar(q, topn=num_synonyms):
-                            qterms.append(w)
-            query = ' '.join(qterms)
-            # print(query)
-            bm25_scores = bm25.get_scores(gensim.utils.simple_preprocess(query))
-            # bm25_scores = bm25.get_scores(gensim.utils.simple_preprocess(query), 0.5)
-        else:
-            for qterm in query:
-                qterm = qterm.lower()
-                words = ''
-                if num_synonyms > 0:
-                    for wo in qterm.split(' '):
-                        if wo in model.wv:
-                            for (w, score) in model.wv.most_similar(q, topn=num_synonyms):
-                                words += ' ' + w
-                scores = bm25.get_scores(gensim.utils.simple_preprocess(qterm + words))
-                # scores = bm25.get_scores(gensim.utils.simple_preprocess(qterm + words), 0.5)
-                if len(bm25_scores) == 0:
-                    bm25_scores = list(scores)
-                else:
-                    for i in range(len(scores)):
-                        bm25_scores[i] += scores[i]
-        hid = 0
-        for hname in hotels:
-            score = bm25_scores[hid] * float(hotels[hname][rank_rating_attr2])
-            result.append((hname, score))
-            hid += 1
-        return sorted(result, key=lambda x : -x[1])[:10]
+                combined_review += ' ' + review
+            tokens[hname] = gensim.utils.simple_preprocess(combined_review)
+        if cache_fn != None:
+            os.makedirs(os.path.dirname(cache_fn), exist_ok=True)
+            # written aside and then renamed, so that an interrupted run
+            # cannot leave a truncated cache behind
+            with open(cache_fn + '.tmp', 'wb') as fout:
+                pickle.dump(tokens, fout)
+            os.replace(cache_fn + '.tmp', cache_fn)
 
-    bm25 = build_index(entities)
-    results = []
-    for query in queries:
-        pairs = baseline(query, entities)
-        bids = [p[0] for p in pairs]
-        results.append(bids)
-    return results
+    # build bm25 index
+    corpus = [tokens[h] for h in hotels]
+    bm25 = opinedb.SparseBM25(corpus)
+    return bm25
+
+
+def IR_baseline(entities, queries, bm25, entity_type='hotel'):
+
+    rank_rating_attr2 = 'review_count' if entity_type == 'restaurant' else 'Overall Rating'
+
+    import gensim
+
+    bid_array = np.array(list(entities.keys()))
+    ratings = np.array([float(entities[bid][rank_rating_attr2]) for bid in bid_array])
+    # all query terms are merged into a single bm25 query
+    tokens = [gensim.utils.simple_preprocess(' '.join([qterm.lower() for qterm in query]))
+              for query in queries]
+    scores = bm25.get_batch_scores(tokens) * ratings
+    return [top_k(bid_array, row) for row in scores]
 
 
 def read_groundtruth(query_label_fn):
@@ -158,43 +232,105 @@ def read_queries(query_fn):
     return queries
 
 
-def discounted_cumulative_gain(query, ranklist, ground_truth):
-    score = 0.0
-    for (i, bid) in enumerate(ranklist):
-        for qterm in query:
-            if (bid, qterm) in ground_truth:
-                score += ground_truth[(bid, qterm)] / math.log2(i + 2)
-    return score
-
-all_bids = [] # set([])
-previous_query = None
-previous_max_dcg = 0.0
+# 1 / log2(i + 2) for each rank position i, extended on demand for longer ranklists
+_LOG2_INV = np.array([1.0 / math.log2(i + 2) for i in range(32)])
+
+
+def _rank_discounts(n):
+    global _LOG2_INV
+    if n > len(_LOG2_INV):
+        _LOG2_INV = np.array([1.0 / math.log2(i + 2) for i in range(n)])
+    return _LOG2_INV[:n]
+
+
+bid_to_id = {}
+term_to_id = {}
+gt_matrix = None
+def index_groundtruth(ground_truth):
+    """
+    Build (once) a dense label matrix with one row per entity and one column
+    per labeled query term. Missing labels count as 0.
+
+    Args:
+        ground_truth (Dict): the labels of (bid, qterm) pairs
+    Returns:
+        np.array: a float32 matrix of shape (num_entities, num_terms)
+    """
+    global gt_matrix
+    if gt_matrix is None:
+        for bid in entities:
+            bid_to_id[bid] = len(bid_to_id)
+        for (_, qterm) in ground_truth:
+            if qterm not in term_to_id:
+                term_to_id[qterm] = len(term_to_id)
+        gt_matrix = np.zeros((len(bid_to_id), len(term_to_id)), dtype=np.float32)
+        for (bid, qterm), label in ground_truth.items():
+            gt_matrix[bid_to_id[bid], term_to_id[qterm]] = label
+    return gt_matrix
+
+
+def parse_query(query, ground_truth):
+    """
+    Parse a query once before scoring it against many entities. Terms without
+    any label are dropped (they score 0 for every entity) and repeated terms
+    are merged into a weight.
+
+    Args:
+        query (List of str): a list of query terms
+        ground_truth (Dict): the labels of (bid, qterm) pairs
+    Returns:
+        List of (int, int): the column ids of the labeled query terms in the
+            label matrix and their multiplicities
+    """
+    index_groundtruth(ground_truth)
+    parsed = {}
+    for qterm in query:
+        if qterm in term_to_id:
+            tid = term_to_id[qterm]
+            parsed[tid] = parsed.get(tid, 0) + 1
+    return list(parsed.items())
+
+
+def get_query_score(bid_ids, parsed_query, ground_truth):
+    """
+    Compute the relevance of a parsed query for a batch of entities.
+
+    Args:
+        bid_ids (np.array or slice): the row ids of the entities
+        parsed_query (List of (int, int)): the output of parse_query
+        ground_truth (Dict): the labels of (bid, qterm) pairs
+    Returns:
+        np.array: the score of each entity
+    """
+    gt = index_groundtruth(ground_truth)
+    if len(parsed_query) == 0:
+        return np.zeros(len(gt[bid_ids]))
+    term_ids = [tid for (tid, _) in parsed_query]
+    weights = np.array([weight for (_, weight) in parsed_query], dtype=np.float32)
+    return gt[bid_ids][:, term_ids].dot(weights).astype(np.float64)
+
+
+def discounted_cumulative_gain(parsed_query, ranklist, ground_truth):
+    bid_ids = np.array([bid_to_id[bid] for bid in ranklist], dtype=np.intp)
+    gains = get_query_score(bid_ids, parsed_query, ground_truth)
+    return float(np.dot(gains, _rank_discounts(len(gains))))
+
+_max_dcg_cache = {}
 def normalized_discounted_cumulative_gain(query, ranklist, ground_truth):
-    global previous_query
-    global previous_max_dcg
-    global all_bids
+    query = parse_query(query, ground_truth)
     # find max rank
-    if query == previous_query:
-        max_score = previous_max_dcg
+    key = tuple(query)
+    if key in _max_dcg_cache:
+        max_score = _max_dcg_cache[key]
     else:
-        if len(all_bids) == 0:
-            # bid_set = set([])
-            # for (bid, _) in ground_truth:
-            #     bid_set.add(bid)
-            # all_bids += list(bid_set)
-            all_bids += list(entities.keys())
-
-        bids = all_bids
-        scores = {}
-        for bid in bids:
-            scores[bid] = 0.0
-            for qterm in query:
-                if (bid, qterm) in ground_truth:
-                    scores[bid] += ground_truth[(bid, qterm)]
-        bids = sorted(bids, key=lambda x : -scores[x])[:10]
-        max_score = discounted_cumulative_gain(query, bids, ground_truth)
-        previous_max_dcg = max_score
-        previous_query = query
+        # the ideal ranklist takes the 10 highest scores over all entities
+        # (selected with a partial sort, then ordered)
+        gains = -get_query_score(slice(None), query, ground_truth)
+        if len(gains) > 10:
+            gains = np.partition(gains, 9)[:10]
+        gains = -np.sort(gains)
+        max_score = float(np.dot(gains, _rank_discounts(len(gains))))
+        _max_dcg_cache[key] = max_score
 
     score = discounted_cumulative_gain(query, ranklist, ground_truth)
     if max_score == 0:
@@ -202,7 +338,45 @@ def normalized_discounted_cumulative_gain(query, ranklist, ground_truth):
     return score / max_score
 
 
-def run_experiment(entities, opine, entity_type='hotel', seed=123):
+def ab_scores(query, ab_results, ground_truth):
+    """
+    Score a query against each AB method as the best NDCG among the method's
+    ranklists.
+
+    Args:
+        query (List of str): a list of query terms
+        ab_results (List): the ranklists of each AB method
+        ground_truth (Dict): the labels of (bid, qterm) pairs
+    Returns:
+        List of float: the score of each AB method
+    """
+    results = []
+    for ranklists in ab_results:
+        score = 0.0
+        for ranklist in ranklists:
+            new_score = normalized_discounted_cumulative_gain(query, ranklist, ground_truth)
+            score = max(score, new_score)
+        results.append(score)
+    return results
+
+
+_worker_args = ()
+def _init_worker(label_index, *args):
+    # install the label matrix built by the parent process and the
+    # arguments shared by all tasks
+    global gt_matrix, _worker_args
+    bid_to_id.update(label_index[0])
+    term_to_id.update(label_index[1])
+    gt_matrix = label_index[2]
+    _worker_args = args
+
+
+def _ab_scores_worker(query):
+    return ab_scores(query, *_worker_args)
+
+
+def run_experiment(entities, opine, entity_type='hotel', seed=123, corpus_cache_fn=None,
+                   workers=None):
     random.seed(seed)
     np.random.seed(seed)
     simple_queries = generate_queries(query_terms, n=100, k=3)
@@ -216,58 +390,61 @@ def run_experiment(entities, opine, entity_type='hotel', seed=123):
     else:
         ab_results = AB_baseline_restaurant(entities)
 
-    ds_names = ['easy', 'medium', 'hard']
-    for ds_name, queries in zip(ds_names, [simple_queries, medium_queries, hard_queries]):
-        print(ds_name)
-        # IR
-        ir_results = IR_baseline(entities, queries, entity_type)
-        scores = []
-        for (query, ranklist) in zip(queries, ir_results):
-            scores.append(normalized_discounted_cumulative_gain(query, ranklist, ground_truth))
-        print('IR-based\t%f' % (sum(scores) / len(scores)))
-
-        # AB
-        scores = [[] for _ in range(4)]
-        for query in queries:
-            results = []
-            for ranklists in ab_results:
-                score = 0.0
-                for ranklist in ranklists:
-                    new_score = normalized_discounted_cumulative_gain(query, ranklist, ground_truth)
-                    score = max(score, new_score)
-                results.append(score)
-            # print(query, results)
-            for i in range(4):
-                scores[i].append(results[i])
-        for i, score_list in enumerate(scores):
-            print('AB method %d\t%f' % (i, sum(score_list) / len(score_list)))
-
-        # run opine
-        for mode in ['marker', 'histogram']:
-            opine.clear_cache()
-            start_time = time.time()
+    bm25 = build_index(entities, corpus_cache_fn)
+    bid_list = list(entities.keys())
+
+    # the queries are scored against the AB baselines in parallel; opine
+    # itself runs serially since its running time is part of the results
+    index_groundtruth(ground_truth)
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=((bid_to_id, term_to_id, gt_matrix),
+                                       ab_results, ground_truth)) as pool:
+        ds_names = ['easy', 'medium', 'hard']
+        for ds_name, queries in zip(ds_names, [simple_queries, medium_queries, hard_queries]):
+            print(ds_name)
+            # IR
+            ir_results = IR_baseline(entities, queries, bm25, entity_type)
             scores = []
-            for query in queries:
-                ranklist = opine.opine(query, bids=list(entities.keys()), mode=mode)[:10]
+            for (query, ranklist) in zip(queries, ir_results):
                 scores.append(normalized_discounted_cumulative_gain(query, ranklist, ground_truth))
-
-            run_time = time.time() - start_time
-            quality = sum(scores) / len(scores)
-            print('Opine - %s, score = %f' % (mode, quality))
-            print('Opine - %s, running time = %f' % (mode, run_time))
-
-        print()
+            print('IR-based\t%f' % (sum(scores) / len(scores)))
+
+            # AB
+            scores = [[] for _ in range(4)]
+            chunksize = max(1, len(queries) // (4 * workers))
+            for results in pool.map(_ab_scores_worker, queries, chunksize=chunksize):
+                for i in range(4):
+                    scores[i].append(results[i])
+            for i, score_list in enumerate(scores):
+                print('AB method %d\t%f' % (i, sum(score_list) / len(score_list)))
+
+            # run opine
+            for mode in ['marker', 'histogram']:
+                opine.clear_cache()
+                start_time = time.time()
+                scores = []
+                for query in queries:
+                    ranklist = opine.opine(query, bids=bid_list, mode=mode)[:10]
+                    scores.append(normalized_discounted_cumulative_gain(query, ranklist, ground_truth))
+
+                run_time = time.time() - start_time
+                quality = sum(scores) / len(scores)
+                print('Opine - %s, score = %f' % (mode, quality))
+                print('Opine - %s, running time = %f' % (mode, run_time))
+
+            print()
 
 
 def read_entities(entity_fn, histogram_fn):
-    entities = json.load(open(entity_fn))
     histograms = json.load(open(histogram_fn))
-    for ent in entities:
+    entities = {}
+    # merge the histograms and index by business_id in a single pass
+    for ent in json.load(open(entity_fn)):
         bid = ent['business_id']
-        if bid in histograms:
-            for key in histograms[bid]:
-                ent[key] = histograms[bid][key]
-    entities = {ent['business_id'] : ent for ent in entities}
+        ent.update(histograms.get(bid, {}))
+        entities[bid] = ent
     print('num entities =\t%d' % len(entities))
     return entities
 
@@ -317,5 +494,6 @@ if __name__ == '__main__':
     ground_truth = read_groundtruth(label_fn)
     op = opinedb.SimpleOpine(histogram_fn, extraction_fn, phrase_sentiment_fn, word2vec_fn, idf_fn, labels_fn)
 
-    run_experiment(entities, op, entity_type, seed=seed)
+    run_experiment(entities, op, entity_type, seed=seed,
+                   corpus_cache_fn=corpus_cache_path(entity_fn, extraction_fn))
 
@@ -4,18 +4,186 @@ import json
 import gensim
 import math
 import random
+import hashlib
+import functools
 import numpy as np
 
 from gensim.models import Word2Vec
-from gensim.summarization.bm25 import get_bm25_weights, BM25
 
+from multiprocessing import Pool
 from scipy import spatial
-from sklearn.neighbors import KDTree
+from scipy import sparse
 from sklearn.linear_model import LogisticRegression
 from sklearn.model_selection import train_test_split
 from nltk.sentiment.vader import SentimentIntensityAnalyzer
 
 
+def load_json(fn):
+    """
+    Load a json file, closing it once parsed.
+
+    Args:
+        fn (str): the path of the json file
+    Returns:
+        the parsed json object
+    """
+    with open(fn) as fin:
+        return json.load(fin)
+
+
+class SparseBM25:
+    """
+    An Okapi BM25 index whose (document, token) weights are computed once at
+    construction and stored in a sparse matrix, so that scoring a query is a
+    single sparse matrix-vector product instead of a Python loop over the
+    documents. The weighting is the same as gensim's BM25: k1 = 1.5, b = 0.75,
+    and a negative idf is replaced by epsilon times the average idf.
+
+    Attributes:
+        corpus_size (int): the number of documents
+        token2col (Dict): a dictionary from token to its column in weights
+        weights (csr_matrix): the BM25 weight of each (document, token) pair
+    """
+    def __init__(self, corpus, k1=1.5, b=0.75, epsilon=0.25):
+        self.corpus_size = len(corpus)
+        self.token2col = {}
+        rows = []
+        cols = []
+        freqs = []
+        doc_len = np.zeros(self.corpus_size)
+        for (i, document) in enumerate(corpus):
+            doc_len[i] = len(document)
+            frequencies = {}
+            for token in document:
+                frequencies[token] = frequencies.get(token, 0) + 1
+            for token, freq in frequencies.items():
+                if token not in self.token2col:
+                    self.token2col[token] = len(self.token2col)
+                rows.append(i)
+                cols.append(self.token2col[token])
+                freqs.append(freq)
+
+        rows = np.array(rows, dtype=np.int64)
+        cols = np.array(cols, dtype=np.int64)
+        freqs = np.array(freqs, dtype=np.float64)
+        vocab_size = len(self.token2col)
+
+        df = np.bincount(cols, minlength=vocab_size)
+        idf = np.log(self.corpus_size - df + 0.5) - np.log(df + 0.5)
+        if vocab_size > 0:
+            idf[idf < 0] = epsilon * idf.mean()
+        avgdl = doc_len.sum() / self.corpus_size
+        data = idf[cols] * freqs * (k1 + 1) / \
+            (freqs + k1 * (1 - b + b * doc_len[rows] / avgdl))
+        self.weights = sparse.csr_matrix((data, (rows, cols)),
+                                         shape=(self.corpus_size, vocab_size))
+
+    def get_scores(self, tokens):
+        """
+        Compute the BM25 score of a tokenized query for every document.
+
+        Args:
+            tokens (List of str): the query tokens (repeated tokens count
+                multiple times)
+        Returns:
+            np.array: the score of each document
+        """
+        qvec = np.zeros(len(self.token2col))
+        for token in tokens:
+            if token in self.token2col:
+                qvec[self.token2col[token]] += 1
+        return self.weights.dot(qvec)
+
+    def get_batch_scores(self, queries):
+        """
+        Compute the BM25 scores of a batch of tokenized queries with one sparse
+        matrix product.
+
+        Args:
+            queries (List of List of str): the tokens of each query
+        Returns:
+            np.array: a matrix of shape (num_queries, corpus_size)
+        """
+        rows = []
+        cols = []
+        for (i, tokens) in enumerate(queries):
+            for token in tokens:
+                if token in self.token2col:
+                    rows.append(i)
+                    cols.append(self.token2col[token])
+        # repeated (query, token) entries are summed into term frequencies
+        qmat = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                                 shape=(len(queries), len(self.token2col)))
+        return qmat.dot(self.weights.T).toarray()
+
+
+def gather_segments(offsets, idx):
+    """
+    Gather the elements of several segments of a concatenated array.
+
+    Args:
+        offsets (np.array): segment i spans offsets[i]:offsets[i + 1]
+        idx (np.array): the segments to gather
+    Returns:
+        np.array: the positions of the gathered elements, segment by segment
+        np.array: the row (in idx) of each gathered element
+        np.array: the rank of each gathered element within its segment
+    """
+    starts = offsets[idx]
+    lengths = offsets[idx + 1] - starts
+    rows = np.repeat(np.arange(len(idx)), lengths)
+    ranks = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return starts[rows] + ranks, rows, ranks
+
+
+def review_text(review):
+    """
+    Get the text of a review.
+
+    Args:
+        review (Dict): the review object (with either a 'text' or a 'review' field)
+    Returns:
+        str: the review's text
+    """
+    if 'text' in review:
+        return review['text']
+    else:
+        return review['review']
+
+
+def sentiment_cache_path(extraction_fn):
+    """
+    Name the sentiment cache of a review file after the file's path and
+    modification time, so that the cache is invalidated whenever the reviews
+    change.
+
+    Args:
+        extraction_fn (str): the path of the reviews with their extractions
+    Returns:
+        str: the path of the cache file (next to the review file)
+    """
+    key = hashlib.sha1(('%s:%f;' % (extraction_fn, os.path.getmtime(extraction_fn))).encode())
+    return '%s.sentiment_%s.json' % (extraction_fn, key.hexdigest())
+
+
+vader = None
+
+def vader_compound(text):
+    """
+    Compute the Vader compound sentiment score of a text (the analyzer is
+    created once per process).
+
+    Args:
+        text (str): the input text
+    Returns:
+        float: the compound score in [-1, 1]
+    """
+    global vader
+    if vader == None:
+        vader = SentimentIntensityAnalyzer()
+    return vader.polarity_scores(text)['compound']
+
+
 class CooccurInterpreter:
     """
     The co-occurrence query interpreter. When a query predicate is not similar
@@ -25,40 +193,81 @@ class CooccurInterpreter:
     Attributes:
         reviews (Dict): a dictionary from review_id to the review objects
         review_ids (List): the list of all review ids
+        sentiment_vec (np.array): the sentiment score of each review in review_ids
         interpret_cache (Dict): a dictionary caching interpretation results
-        position_index (Dict): an index for fast look-up of position of tokens
+        position_index (Dict): an index for fast look-up of position of tokens: for
+            each review, a dictionary from token to its group, the int32 positions
+            of all tokens grouped by token, and the offsets of each group
+        extraction_positions (Dict): the sorted token positions of each extraction
+            of each review (computed on first use)
         idf (Dict): stores the idf of each attribute
+
+    Args:
+        reviews (List): the review objects with their extractions
+        sentiment_cache_fn (str): a json file caching the sentiment of each review
+            (optional, see sentiment_cache_path)
+        min_pool_size (int): the number of uncached reviews from which their
+            sentiments are computed in a process pool
     """
-    def __init__(self, reviews):
+    def __init__(self, reviews, sentiment_cache_fn=None, min_pool_size=1000):
         reviews = { review['review_id'] : review for review in reviews }
         self.reviews = reviews
         self.review_ids = []
         self.interpret_cache = {}
         self.position_index = {}
+        self.extraction_positions = {}
         self.idf = {}
 
+        def add_sentiments():
+            # reviews that already have a sentiment keep it; the others are read from
+            # the cache file or computed with Vader (in parallel if there are many of
+            # them) and then cached
+            missing = [rid for rid in reviews if 'sentiment' not in reviews[rid]]
+            if len(missing) == 0:
+                return
+            sentiments = {}
+            if sentiment_cache_fn != None and os.path.exists(sentiment_cache_fn):
+                sentiments = load_json(sentiment_cache_fn)
+            uncached = [rid for rid in missing if rid not in sentiments]
+            if len(uncached) > 0:
+                texts = [review_text(reviews[rid]) for rid in uncached]
+                if len(uncached) < min_pool_size:
+                    scores = [vader_compound(text) for text in texts]
+                else:
+                    with Pool() as pool:
+                        scores = pool.map(vader_compound, texts, chunksize=256)
+                sentiments.update(zip(uncached, scores))
+                if sentiment_cache_fn != None:
+                    # written aside and then renamed, so that an interrupted run
+                    # cannot leave a truncated cache behind; caching is skipped
+                    # if the directory is not writable
+                    try:
+                        with open(sentiment_cache_fn + '.tmp', 'w') as fout:
+                            json.dump(sentiments, fout)
+                        os.replace(sentiment_cache_fn + '.tmp', sentiment_cache_fn)
+                    except OSError as e:
+                        print('cannot cache the review sentiments: %s' % e, file=sys.stderr)
+            for rid in missing:
+                reviews[rid]['sentiment'] = sentiments[rid]
+
         def build_index():
             # build bm25 index
             corpus = []
             total = 0.0
-            SIA = SentimentIntensityAnalyzer()
             for rid in reviews:
                 self.review_ids.append(rid)
-                if 'text' in reviews[rid]:
-                    sent = reviews[rid]['text']
-                else:
-                    sent = reviews[rid]['review']
-
-                tokens = gensim.utils.simple_preprocess(sent.lower())
-                reviews[rid]['sentiment'] = SIA.polarity_scores(sent)['compound']
+                tokens = gensim.utils.simple_preprocess(review_text(reviews[rid]).lower())
 
                 corpus.append(tokens)
-                self.position_index[rid] = {}
-                for (pos, token) in enumerate(tokens):
-                    if token not in self.position_index[rid]:
-                        self.position_index[rid][token] = [pos]
-                    else:
-                        self.position_index[rid][token].append(pos)
+                # one flat array per review, with the positions of each token in
+                # a contiguous (sorted) group
+                groups = {}
+                token_groups = np.array([groups.setdefault(token, len(groups)) for token in tokens],
+                                        dtype=np.int32)
+                positions = np.argsort(token_groups, kind='stable').astype(np.int32)
+                offsets = np.zeros(len(groups) + 1, dtype=np.int32)
+                np.cumsum(np.bincount(token_groups, minlength=len(groups)), out=offsets[1:])
+                self.position_index[rid] = (groups, positions, offsets)
 
                 for ext in reviews[rid]['extractions']:
                     attr = ext['attribute']
@@ -67,44 +276,72 @@ class CooccurInterpreter:
                     else:
                         self.idf[attr] += 1
                     total += 1
-            bm25 = BM25(corpus)
+            bm25 = SparseBM25(corpus)
+            self.sentiment_vec = np.array([reviews[rid]['sentiment'] for rid in self.review_ids])
             for attr in self.idf:
                 self.idf[attr] = math.log2(total / self.idf[attr])
             return bm25
+        add_sentiments()
         self.bm25 = build_index()
 
 
-    def get_dist(self, position_index, phrase1, phrase2):
+    def get_positions(self, position_index, tokens):
         """
-        Compute the distance of two phrases in a single review as the
-        minimal distance among the tokens in the two phrases.
+        Collect the positions of a list of tokens in a single review.
+
+        Args:
+            position_index (Tuple): the index of a review for position look-up
+            tokens (List of str): the tokens to look up
+        Returns:
+            np.array: the sorted positions of all the tokens
+        """
+        groups, all_positions, offsets = position_index
+        positions = [all_positions[offsets[groups[token]]:offsets[groups[token] + 1]] \
+                     for token in tokens if token in groups]
+        if len(positions) == 0:
+            return np.zeros(0, dtype=np.int32)
+        return np.sort(np.concatenate(positions))
+
+
+    def get_extraction_positions(self, rid):
+        """
+        Get the token positions of each extraction of a review, tokenizing the
+        extractions only the first time the review is visited.
 
         Args:
-            position_index (Dict): an index of a review for position look-up
-            phrase1 (string): the first phrase
-            phrase2 (string): the second phrase
+            rid (str): the review id
         Returns:
-            int: the distance
+            List of np.array: the sorted token positions of each extraction
         """
-        tokens1 = gensim.utils.simple_preprocess(phrase1.lower())
-        tokens2 = gensim.utils.simple_preprocess(phrase2.lower())
+        if rid not in self.extraction_positions:
+            self.extraction_positions[rid] = []
+            for ext in self.reviews[rid]['extractions']:
+                phrase = ext['predicate'] + ' ' + ext['entity']
+                phrase_tokens = gensim.utils.simple_preprocess(phrase.lower())
+                self.extraction_positions[rid].append(
+                    self.get_positions(self.position_index[rid], phrase_tokens))
+        return self.extraction_positions[rid]
 
-        positions1 = []
-        for token1 in tokens1:
-            if token1 in position_index:
-                positions1 += position_index[token1]
 
-        positions2 = []
-        for token2 in tokens2:
-            if token2 in position_index:
-                positions2 += position_index[token2]
+    def get_dist(self, positions1, positions2):
+        """
+        Compute the distance of two phrases in a single review as the
+        minimal distance among the tokens in the two phrases.
 
-        result = -1
-        for p1 in positions1:
-            for p2 in positions2:
-                if result < 0 or abs(p1 - p2) < result:
-                    result = abs(p1 - p2)
-        return result
+        Args:
+            positions1 (np.array): the sorted token positions of the first phrase
+            positions2 (np.array): the sorted token positions of the second phrase
+        Returns:
+            int: the distance (-1 if either phrase does not occur)
+        """
+        if len(positions1) == 0 or len(positions2) == 0:
+            return -1
+        # the closest position of phrase1 to each position of phrase2 is one of
+        # its two neighbors in positions1
+        idx = np.searchsorted(positions1, positions2)
+        left = positions1[np.maximum(idx - 1, 0)]
+        right = positions1[np.minimum(idx, len(positions1) - 1)]
+        return int(np.minimum(np.abs(positions2 - left), np.abs(right - positions2)).min())
 
 
     def interpret(self, qterm, debug=False):
@@ -121,34 +358,34 @@ class CooccurInterpreter:
         if qterm in self.interpret_cache:
             return self.interpret_cache[qterm]
 
-        scores = self.bm25.get_scores(gensim.utils.simple_preprocess(qterm))
-        # scores = self.bm25.get_scores(gensim.utils.simple_preprocess(qterm), 0.5)
-        score_mp = {}
-        for (i, rid) in enumerate(self.review_ids):
-            if scores[i] > 0:
-                score_mp[rid] = scores[i] * self.reviews[rid]['sentiment']
-            else:
-                score_mp[rid] = 0.0
+        # simple_preprocess lowercases, so the same tokens serve BM25 and positions
+        qtokens = gensim.utils.simple_preprocess(qterm)
+        scores = self.bm25.get_scores(qtokens)
+        scores = np.where(scores > 0, scores * self.sentiment_vec, 0.0)
+
+        # the (at most) 10 positive reviews of highest score; ties are kept in
+        # review order
+        top = np.flatnonzero(scores > 0)
+        if len(top) > 10:
+            threshold = np.partition(-scores[top], 9)[9]
+            top = top[-scores[top] <= threshold]
+        top = top[np.argsort(-scores[top], kind='stable')][:10]
 
-        sorted_review_ids = sorted(self.review_ids, key=lambda x : -score_mp[x])
         attribute_scores = {}
         represented_phrases = {}
 
-        for rid in sorted_review_ids[:10]:
-            if score_mp[rid] <= 0:
-                continue
+        for i in top:
+            rid = self.review_ids[i]
             extractions = self.reviews[rid]['extractions']
+            qpositions = self.get_positions(self.position_index[rid], qtokens)
             if debug:
-                if 'text' in self.reviews[rid]:
-                    print(self.reviews[rid]['text'])
-                else:
-                    print(self.reviews[rid]['review'])
+                print(review_text(self.reviews[rid]))
             min_dist = -1
             min_dist_phrase = ''
             min_dist_attr = None
-            for ext in extractions:
+            for (ext, positions) in zip(extractions, self.get_extraction_positions(rid)):
                 phrase = ext['predicate'] + ' ' + ext['entity']
-                dist = self.get_dist(self.position_index[rid], phrase, qterm)
+                dist = self.get_dist(positions, qpositions)
                 if dist >= 0 and (min_dist < 0 or dist < min_dist):
                     min_dist = dist
                     min_dist_phrase = phrase
@@ -188,39 +425,68 @@ class SimpleOpine:
         entities (Dict): a dictionary where each item is an entity
         model (Word2Vec): a word2vec model trained on reviews
         idf (Dict): a dictionary of the pre-computed idf of each token
-        phrase2vec_cache (Dict): cache for already computed phrase vectors
+        word_index (Dict): a dictionary from token to its row in word_vectors
+        word_vectors (np.array): the word2vec vector of each token
+        idf_vec (np.array): the idf of each token, aligned with word_vectors
         all_phrases (List): the list of all extracted phrases (for query interpretation)
-        membership_cache (Dict): cache the attribute score
+        all_vectors (np.array): the unit vector of each phrase in all_phrases
+            (zero for phrases without any known token)
+        all_sq_norms (np.array): the squared norm of each row of all_vectors
+        histogram_columns (Dict): for each attribute, the positions of the entities
+            having a histogram of it, the offsets of each entity's phrases, the
+            phrase ids, counts and sentiments of all the histograms, and the
+            query-independent parts of each entity's phrase features
+        summary_columns (Dict): for each attribute, the entities having a summary
+            of it, the offsets of each entity's markers, and the unit centers,
+            sums of sentiments, sizes and average sentiments of all the markers
+        bid_index (Dict): a dictionary from bid to its position in entities
+        scorers (Dict): the feature columns, batched feature function and model
+            used by each membership mode ('marker' or 'histogram')
+        membership_cache (Dict): cache the attribute scores of all the entities (by
+            bid_index) for each (mode, attribute, query term)
         interpret_cache (Dict): cache the query interpretation results
+        marker_index (Dict): the unit marker centers and verbalized markers of
+            each attribute (built on first use)
     """
 
     def __init__(self, histogram_fn, extraction_fn, phrase_sentiment_fn, word2vec_fn, idf_fn, query_label_fn, entity_fn=None):
-        if entity_fn == None:
-            self.entities = json.load(open(histogram_fn))
-            self.reviews = json.load(open(extraction_fn))
-        else:
-            bids = set([])
-            raw_entities = json.load(open(entity_fn))
-            for row in raw_entities:
-                bids.add(row['business_id'])
+        self.entities = load_json(histogram_fn)
+        self.reviews = load_json(extraction_fn)
+        if entity_fn != None:
             # filtering
-            self.entities = json.load(open(histogram_fn))
+            bids = set(row['business_id'] for row in load_json(entity_fn))
             self.entities = { bid : self.entities[bid] for bid in bids }
-            self.reviews = json.load(open(extraction_fn))
             self.reviews = [review for review in self.reviews if review['business_id'] in bids]
 
-        self.phrase_sentiments = json.load(open(phrase_sentiment_fn))
+        self.phrase_sentiments = load_json(phrase_sentiment_fn)
         self.model = Word2Vec.load(word2vec_fn)
-        self.idf = json.load(open(idf_fn))
-        self.phrase2vec_cache = {}
+        self.idf = load_json(idf_fn)
+
+        # word vectors and their idf weights as arrays (gensim < 4 has no key_to_index)
+        wv = self.model.wv
+        if hasattr(wv, 'key_to_index'):
+            self.word_index = wv.key_to_index
+        else:
+            self.word_index = { w : v.index for (w, v) in wv.vocab.items() }
+        self.word_vectors = wv.vectors
+        self.idf_vec = np.zeros(len(self.word_vectors), dtype=np.float32)
+        for (w, i) in self.word_index.items():
+            self.idf_vec[i] = self.idf.get(w, 0.0)
+
+        # memoize phrase2vec on this instance (emptied by clear_cache)
+        self.phrase2vec = functools.lru_cache(maxsize=None)(self.phrase2vec)
         self.phrase_mp = {}
         self.all_phrases = []
-        self.all_vectors = []
+        self.all_vectors = None
+        self.all_sq_norms = None
         self.membership_cache = {}
         self.interpret_cache = {}
+        self.marker_index = {}
 
         # index for the w2v method for query interpretation
         def build_NN_index():
+            rows = []
+            cols = []
             for bid in self.entities:
                 histogram = self.entities[bid]['histogram']
                 for attr in histogram:
@@ -229,51 +495,132 @@ class SimpleOpine:
                         if phrase not in self.phrase_mp:
                             self.phrase_mp[phrase] = len(self.phrase_mp)
                             self.all_phrases.append((attr, phrase))
-                            self.all_vectors.append(self.phrase2vec(phrase))
-
-            return KDTree(self.all_vectors, leaf_size=40)
-
-        self.kd_tree = build_NN_index()
+                            for w in gensim.utils.simple_preprocess(phrase):
+                                if w in self.word_index:
+                                    rows.append(self.phrase_mp[phrase])
+                                    cols.append(self.word_index[w])
+
+            # all phrase vectors at once as (phrase x token idf weights) * word vectors;
+            # repeated (phrase, token) entries are summed
+            weights = sparse.csr_matrix((self.idf_vec[cols], (rows, cols)),
+                                        shape=(len(self.all_phrases), len(self.word_vectors)))
+            vectors = weights.dot(self.word_vectors)
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            self.all_vectors = (vectors / norms).astype(np.float32)
+            self.all_sq_norms = (self.all_vectors ** 2).sum(axis=1)
+
+        build_NN_index()
+
+        # per-attribute columns over the entities (in the order of self.entities):
+        # which entities have the attribute, and the offsets of each entity's
+        # phrases / markers in the concatenated per-phrase / per-marker arrays
+        def build_columns(field, fields, rows):
+            columns = {}
+            for (i, bid) in enumerate(self.entities):
+                for (attr, items) in self.entities[bid].get(field, {}).items():
+                    if attr not in columns:
+                        columns[attr] = { 'present' : np.zeros(len(self.entities), dtype=bool),
+                                          'lengths' : np.zeros(len(self.entities), dtype=np.int64) }
+                        for name in fields:
+                            columns[attr][name] = []
+                    column = columns[attr]
+                    column['present'][i] = True
+                    values = rows(items)
+                    column['lengths'][i] = len(values)
+                    for (name, value) in zip(fields, zip(*values)):
+                        column[name] += value
+            for column in columns.values():
+                column['offsets'] = np.concatenate([[0], np.cumsum(column.pop('lengths'))])
+                column['entities'] = np.flatnonzero(column.pop('present'))
+            return columns
+
+        # the phrases (as rows of all_vectors), counts and sentiments of each histogram
+        def histogram_rows(histogram):
+            return [(self.phrase_mp[phrase.lower()], histogram[phrase], self.phrase_sentiments[phrase]) \
+                    for phrase in histogram]
+
+        self.histogram_columns = build_columns('histogram', ['phrase_ids', 'counts', 'sentiments'], histogram_rows)
+        for column in self.histogram_columns.values():
+            # counts are small integers, exact in float32
+            column['phrase_ids'] = np.array(column['phrase_ids'], dtype=np.int32)
+            column['counts'] = np.array(column['counts'], dtype=np.float32)
+            column['sentiments'] = np.array(column['sentiments'], dtype=np.float64)
+
+            # the parts of the phrase features that do not depend on the query term
+            counts = column['counts']
+            column['positive'] = column['sentiments'] >= 0
+            column['weighted_sentiments'] = counts * column['sentiments']
+            rows = np.repeat(np.arange(len(self.entities)), np.diff(column['offsets']))
+            def entity_sum(values):
+                return np.bincount(rows, weights=values, minlength=len(self.entities))
+            column['avg_sentiment'] = entity_sum(column['weighted_sentiments']) / (1.0 + entity_sum(counts))
+            column['pos_count'] = entity_sum(counts * column['positive'])
+            column['neg_count'] = entity_sum(counts * ~column['positive'])
+            sum_phrases = sparse.csr_matrix((counts.astype(np.float64), (rows, column['phrase_ids'])),
+                                            shape=(len(self.entities), len(self.all_phrases))).dot(self.all_vectors)
+            column['norm'] = np.linalg.norm(sum_phrases, axis=1)
+
+        # the markers, sum of sentiments and sizes of each summary, ordered by average sentiment
+        def summary_rows(summary):
+            summary = sorted(summary, key=lambda x : x['sum_senti'] / (x['size'] + 1))
+            return [(marker, marker['sum_senti'], marker['size']) for marker in summary]
+
+        self.summary_columns = build_columns('summaries', ['markers', 'sum_senti', 'size'], summary_rows)
+        for column in self.summary_columns.values():
+            column['centers'] = self.unit_centers(column.pop('markers'))
+            column['sum_senti'] = np.array(column['sum_senti'], dtype=np.float64)
+            column['size'] = np.array(column['size'], dtype=np.float32)
+            column['avg_senti'] = column['sum_senti'] / (column['size'] + 1.0)
+
+        self.bid_index = { bid : i for (i, bid) in enumerate(self.entities) }
 
         # index for the co-occurrence method
-        self.cooc = CooccurInterpreter(self.reviews)
+        self.cooc = CooccurInterpreter(self.reviews, sentiment_cache_fn=sentiment_cache_path(extraction_fn))
 
         def train_scorer(num_samples=1500):
             ground_truth = {}
             all_bids = set([])
             all_qterms = set([])
-            for (bid, _, qterm, res) in json.load(open(query_label_fn)):
+            for (bid, _, qterm, res) in load_json(query_label_fn):
                 if bid in self.entities:
                     ground_truth[(bid, qterm)] = 1.0 if res == 'yes' else 0.0
                     all_bids.add(bid)
                     all_qterms.add(qterm)
             all_bids = list(all_bids)
             all_qterms = list(all_qterms)
-            X_phrases = []
-            X_summary = []
-            y_phrases = []
-            y_summary = []
-            while len(X_phrases) < num_samples:
+            # draw the samples first so that they can be featurized in batches
+            samples = []
+            while len(samples) < num_samples:
                 bid = random.choice(all_bids)
                 qterm = random.choice(all_qterms)
                 attr_name, _ = self.interpret(qterm)
                 if attr_name in self.entities[bid]['summaries']:
-                    # print(bid, attr_name, qterm)
-                    X_phrases.append(self.get_features_phrases(self.entities[bid]['histogram'][attr_name], qterm))
-                    X_summary.append(self.get_features_summary(self.entities[bid]['summaries'][attr_name], qterm))
-                    if (bid, qterm) in ground_truth and ground_truth[(bid, qterm)] > 0:
-                        y_phrases.append(1)
-                        y_summary.append(1)
-                    else:
-                        y_phrases.append(0)
-                        y_summary.append(0)
+                    samples.append((bid, attr_name, qterm))
+
+            # 8 phrase features, and 5 features for each of the (up to) 10 markers
+            # (kept in float64 so that the solvers fit in double precision)
+            X_phrases = np.empty((num_samples, 8), dtype=np.float64)
+            X_summary = np.empty((num_samples, 50), dtype=np.float64)
+            y = np.array([1 if ground_truth.get((bid, qterm), 0.0) > 0 else 0 \
+                          for (bid, _, qterm) in samples])
+
+            # the samples of the same (attribute, query term) are featurized together
+            groups = {}
+            for (i, (_, attr_name, qterm)) in enumerate(samples):
+                groups.setdefault((attr_name, qterm), []).append(i)
+            for ((attr_name, qterm), rows) in groups.items():
+                qvec = self.phrase2vec(qterm)
+                idx = np.array([self.bid_index[samples[i][0]] for i in rows], dtype=np.int64)
+                X_phrases[rows] = self.get_features_phrases_batch(idx, attr_name, qvec)
+                X_summary[rows] = self.get_features_summary_batch(idx, attr_name, qvec)
 
             X_summary, X_summary_test, y_summary, y_summary_test = \
-                train_test_split(np.array(X_summary), y_summary, test_size=0.33)
+                train_test_split(X_summary, y, test_size=0.33)
             marker_model = LogisticRegression().fit(X_summary, y_summary)
 
             X_phrases, X_phrases_test, y_phrases, y_phrases_test = \
-                train_test_split(np.array(X_phrases), y_phrases, test_size=0.33)
+                train_test_split(X_phrases, y, test_size=0.33)
             phrase_model = LogisticRegression().fit(X_phrases, y_phrases)
 
             print('phrase model score = %f' % phrase_model.score(X_phrases_test, y_phrases_test))
@@ -282,11 +629,16 @@ class SimpleOpine:
 
         self.phrase_model, self.marker_model = train_scorer()
 
+        # the feature columns, batched feature function and model of each scoring mode
+        self.scorers = {
+            'marker' : (self.summary_columns, self.get_features_summary_batch, self.marker_model),
+            'histogram' : (self.histogram_columns, self.get_features_phrases_batch, self.phrase_model) }
+
     def clear_cache(self):
         """
         clear the membership function's cache and the interpreter's cache (for experiment purpose).
         """
-        self.phrase2vec_cache = {}
+        self.phrase2vec.cache_clear()
         self.membership_cache = {}
         self.interpret_cache = {}
 
@@ -298,24 +650,17 @@ class SimpleOpine:
         Args:
             phrase (str): the input phrase
         Returns:
-            A 300d vector
+            np.array: a 300d float32 vector
         """
-        if phrase in self.phrase2vec_cache:
-            return self.phrase2vec_cache[phrase]
-
         words = gensim.utils.simple_preprocess(phrase)
-        res = np.zeros(300)
-        for w in words:
-            if w in self.model.wv:
-                v = self.model.wv[w] * self.idf[w]
-                res += v
+        ids = [self.word_index[w] for w in words if w in self.word_index]
+        res = (self.word_vectors[ids] * self.idf_vec[ids, None]).sum(axis=0, dtype=np.float32)
         #if phrase in self.phrase_sentiments and self.phrase_sentiments[phrase] < 0:
         #    res = -res
         norm = np.linalg.norm(res)
         if norm > 0:
             res /= norm
 
-        self.phrase2vec_cache[phrase] = res
         return res
 
     def cosine(self, vec1, vec2):
@@ -336,107 +681,156 @@ class SimpleOpine:
             return 0.0
         # return 1.0 - spatial.distance.cosine(vec1, vec2)
 
-    def get_marker(self, attr, phrase):
+    def unit_centers(self, markers):
+        """
+        Stack the normalized centers of a list of markers.
+
+        Args:
+            markers (List): a list of marker objects
+        Returns:
+            np.array: a matrix whose i-th row is the unit center of the i-th
+                marker (zero if the center is zero)
+        """
+        centers = np.array([marker['center'] for marker in markers], dtype=np.float32)
+        centers = centers.reshape(len(markers), self.word_vectors.shape[1])
+        norms = np.linalg.norm(centers, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return centers / norms
+
+    def get_marker(self, attr, phrase, vec=None):
         """ Find the closest marker to the input phrase.
 
         Args:
             attr (string): the subjective attribute name
             phrase (string): the input phrase
+            vec (np.array): the phrase's vector if already computed
         Returns:
             string: a string representing the best matching marker
         """
-        vec = self.phrase2vec(phrase)
-        best_match = None
-        best_sim = 0.0
-        for entity in self.entities.values():
-            if attr in entity['summaries']:
-                for marker in entity['summaries'][attr]:
-                    marker_vec = marker['center']
-                    sim = self.cosine(vec, marker_vec)
-                    if best_match == None or sim >= best_sim:
-                        best_match = marker['verbalized']
-                        best_sim = sim
-        return best_match
-
-
-    def get_features_phrases(self, histogram, qterm):
+        if attr not in self.marker_index:
+            markers = []
+            for entity in self.entities.values():
+                if attr in entity['summaries']:
+                    markers += entity['summaries'][attr]
+            self.marker_index[attr] = (self.unit_centers(markers),
+                                       [marker['verbalized'] for marker in markers])
+
+        centers, verbalized = self.marker_index[attr]
+        if len(verbalized) == 0:
+            return None
+        # phrase vectors are unit (or zero), so the cosine is a dot product;
+        # ties go to the last marker
+        if vec is None:
+            vec = self.phrase2vec(phrase)
+        sims = centers.dot(vec)
+        return verbalized[len(sims) - 1 - np.argmax(sims[::-1])]
+
+
+    def get_features_phrases(self, bid, attr_name, qterm, qvec=None):
         """Compute the features without using the markers. The features include
         the total positive/negative counts, sum of sentiments, number of similar
         phrases etc.
 
         Args:
-            histogram (Dictionary): a counter dictionary of extracted phrases
-                of a subjective attribute
+            bid (string): the business_id of the entity
+            attr_name (string): the subjective attribute whose histogram of
+                extracted phrases is used
             qterm (string): the input query term
+            qvec (np.array): the query term's vector if already computed
         Returns:
             np.array: an array representing the features
         """
-        qvec = self.phrase2vec(qterm)
-        # count number of similar phrases
-        sim_count = 1.0
-        count2 = 1.0
-        sent_sum = 0.0
-        sent_sum2 = 0.0
-        pos_count = 0.0
-        neg_count = 0.0
-        pos_match_count = 0.0
-        neg_match_count = 0.0
-
-        sum_phrases = np.zeros(300)
-        for phrase in histogram:
-            pvec = self.phrase2vec(phrase)
-            sum_phrases += pvec * histogram[phrase]
-            if self.cosine(qvec, pvec) > 0.8:
-                sim_count += histogram[phrase]
-                sent_sum += histogram[phrase] * self.phrase_sentiments[phrase]
-                if self.phrase_sentiments[phrase] >= 0:
-                    pos_match_count += histogram[phrase]
-                else:
-                    neg_match_count += histogram[phrase]
-
-            sent_sum2 += histogram[phrase] * self.phrase_sentiments[phrase]
-            count2 += histogram[phrase]
-            if self.phrase_sentiments[phrase] >= 0:
-                pos_count += histogram[phrase]
-            else:
-                neg_count += histogram[phrase]
-
-        X = []
-        X.append(sim_count)
-        X.append(sent_sum / sim_count)
-        X.append(sent_sum2 / count2)
-        X.append(pos_count)
-        X.append(neg_count)
-        X.append(pos_match_count)
-        X.append(neg_match_count)
-        X.append(self.cosine(qvec, sum_phrases))
-        return np.array(X)
-
-    def get_features_summary(self, summary, qterm, num_markers=10):
+        if qvec is None:
+            qvec = self.phrase2vec(qterm)
+        idx = np.array([self.bid_index[bid]], dtype=np.int64)
+        return self.get_features_phrases_batch(idx, attr_name, qvec)[0]
+
+    def get_features_phrases_batch(self, idx, attr_name, qvec):
+        """Compute the phrase features (see get_features_phrases) of several entities
+        at once from the attribute's histogram columns.
+
+        Args:
+            idx (np.array): the positions (in bid_index) of entities that have a
+                histogram of attr_name
+            attr_name (string): the subjective attribute
+            qvec (np.array): the query term's vector
+        Returns:
+            np.array: a matrix with the features of each entity as a row
+        """
+        column = self.histogram_columns[attr_name]
+        pos, rows, _ = gather_segments(column['offsets'], idx)
+        counts = column['counts'][pos].astype(np.float64)
+        positive = column['positive'][pos]
+
+        def row_sum(values):
+            return np.bincount(rows, weights=values, minlength=len(idx))
+
+        # similar phrases
+        similarity = self.all_vectors[column['phrase_ids'][pos]].dot(qvec)
+        match = similarity > 0.8
+        sim_count = 1.0 + row_sum(counts * match)
+        # qvec is unit (or zero), so the cosine with the sum of the phrase vectors
+        # is the sum of the phrases' similarities over the sum's norm
+        norms = column['norm'][idx].copy()
+        norms[norms == 0] = np.inf
+
+        return np.column_stack([
+            sim_count,
+            row_sum(column['weighted_sentiments'][pos] * match) / sim_count,
+            column['avg_sentiment'][idx],
+            column['pos_count'][idx],
+            column['neg_count'][idx],
+            row_sum(counts * (match & positive)),
+            row_sum(counts * (match & ~positive)),
+            row_sum(counts * similarity) / norms])
+
+    def get_features_summary(self, bid, attr_name, qterm, num_markers=10, qvec=None):
         """Compute the features from the markers. The features include
         the markers' size, total/average sentiments, and overall similarity
         with the query term.
 
         Args:
-            summary (List): a list of summary objects of a subjective attribute
+            bid (string): the business_id of the entity
+            attr_name (string): the subjective attribute whose summary is used
             qterm (string): the input query term
+            num_markers (int): the number of markers the features are padded to
+            qvec (np.array): the query term's vector if already computed
         Returns:
             np.array: an array representing the features
         """
-        qvec = self.phrase2vec(qterm)
-        num_marker = len(summary)
-        summary.sort(key=lambda x : x['sum_senti'] / (x['size'] + 1))
-        X = []
-        for marker in summary:
-            similarity = self.cosine(marker['center'], qvec)
-            X.append(marker['sum_senti'])
-            X.append(marker['size'])
-            X.append(marker['sum_senti'] / (marker['size'] + 1))
-            X.append(similarity)
-            X.append(marker['sum_senti'] / (marker['size'] + 1) * similarity)
-        for _ in range(num_markers - len(summary)):
-            X += [0.0] * 5
+        if qvec is None:
+            qvec = self.phrase2vec(qterm)
+        idx = np.array([self.bid_index[bid]], dtype=np.int64)
+        return self.get_features_summary_batch(idx, attr_name, qvec, num_markers=num_markers)[0]
 
+    def get_features_summary_batch(self, idx, attr_name, qvec, num_markers=10):
+        """Compute the marker features (see get_features_summary) of several entities
+        at once from the attribute's summary columns.
+
+        Args:
+            idx (np.array): the positions (in bid_index) of entities that have a
+                summary of attr_name
+            attr_name (string): the subjective attribute
+            qvec (np.array): the query term's vector
+            num_markers (int): the number of markers the features are padded to
+        Returns:
+            np.array: a matrix with the features of each entity as a row
+        """
+        column = self.summary_columns[attr_name]
+        pos, rows, ranks = gather_segments(column['offsets'], idx)
+        sum_senti = column['sum_senti'][pos]
+        size = column['size'][pos]
+        avg_senti = column['avg_senti'][pos]
+        similarity = column['centers'][pos].dot(qvec)
+
+        # 5 features per marker written in place into zero-padded rows
+        width = max(num_markers, ranks.max() + 1 if len(ranks) > 0 else 0)
+        X = np.zeros((len(idx), 5 * width))
+        X[rows, 5 * ranks] = sum_senti
+        X[rows, 5 * ranks + 1] = size
+        X[rows, 5 * ranks + 2] = avg_senti
+        X[rows, 5 * ranks + 3] = similarity
+        X[rows, 5 * ranks + 4] = avg_senti * similarity
         return X
 
     def interpret(self, query_term, fallback_threshold=0.4):
@@ -457,14 +851,15 @@ class SimpleOpine:
             return self.interpret_cache[query_term]
         query_len = len(gensim.utils.simple_preprocess(query_term))
         vector = self.phrase2vec(query_term)
-        kd_tree_res = self.kd_tree.query([vector], k=1)
-        phrase_id = kd_tree_res[1][0][0]
+        # the Euclidean nearest neighbor: argmin |p - v|^2 = argmax 2 p.v - |p|^2
+        # (a zero phrase is nearer than any phrase with similarity below 0.5)
+        phrase_id = np.argmax(2 * self.all_vectors.dot(vector) - self.all_sq_norms)
         res = self.all_phrases[phrase_id]
 
         # fall back if similarity is too low
         phrase = res[1]
         phrase_vec = self.phrase2vec(phrase)
-        similarity = self.cosine(phrase_vec, vector)
+        similarity = np.dot(phrase_vec, vector)
         if similarity < fallback_threshold or query_len == 1: # 0.4
             cooc_res = self.cooc.interpret(query_term)
             if cooc_res[0] != None:
@@ -473,6 +868,37 @@ class SimpleOpine:
         self.interpret_cache[query_term] = res
         return res
 
+    def membership_batch(self, idx, attr_name, qterm, mode='marker'):
+        """
+        Compute the membership score of a list of entities for an interpreted
+        query term. The scores are cached per (mode, attribute, query term) and
+        the missing ones are computed with one predict_proba call.
+
+        Args:
+            idx (np.array): the positions (in bid_index) of the entities
+            attr_name (string): the subjective attribute the query term is interpreted as
+            qterm (string): the (lowercased) query term
+            mode (string): 'marker' to score with the markers, otherwise with the histograms
+        Returns:
+            np.array: the score of each entity (1e-6 if it has no data on the attribute)
+        """
+        columns, get_features, model = self.scorers.get(mode, self.scorers['histogram'])
+
+        # the scores of all the entities (by bid_index): 1e-6 for the entities without
+        # data on the attribute, and NaN for the others until computed
+        scores = self.membership_cache.get((mode, attr_name, qterm))
+        if scores is None:
+            scores = np.full(len(self.entities), 1e-6)
+            if attr_name in columns:
+                scores[columns[attr_name]['entities']] = np.nan
+            self.membership_cache[(mode, attr_name, qterm)] = scores
+
+        missing = np.unique(idx[np.isnan(scores[idx])])
+        if len(missing) > 0:
+            features = get_features(missing, attr_name, self.phrase2vec(qterm))
+            scores[missing] = model.predict_proba(features)[:, 1]
+        return scores[idx]
+
     def opine(self, query, bids=None, mode='marker'):
         """
         Compute the ranking score for all entities.
@@ -486,35 +912,26 @@ class SimpleOpine:
             List of strings: a sorted list of bids' by their scores
         """
 
-        def membership(bid, attr_name, qterm):
-            if (bid, attr_name, qterm) in self.membership_cache:
-                return self.membership_cache[(bid, attr_name, qterm)]
-
-            if mode == 'marker':
-                if 'summaries' in self.entities[bid] and attr_name in self.entities[bid]['summaries']:
-                    summary = self.entities[bid]['summaries'][attr_name]
-                    score = self.marker_model.predict_proba([self.get_features_summary(summary, qterm)])[0][1]
-                else:
-                    score = 1e-6
-            else:
-                if 'histogram' in self.entities[bid] and attr_name in self.entities[bid]['histogram']:
-                    histogram = self.entities[bid]['histogram'][attr_name]
-                    score = self.phrase_model.predict_proba([self.get_features_phrases(histogram, qterm)])[0][1]
-                else:
-                    score = 1e-6
-            self.membership_cache[(bid, attr_name, qterm)] = score
-            return score
+        # interpret every query term once up front
+        query = [qterm.lower() for qterm in query]
+        interpretations = { qterm : self.interpret(qterm) for qterm in query }
 
         if bids == None:
             bids = list(self.entities.keys())
-        scores = {bid : 1.0 for bid in bids}
-
+            idx = np.arange(len(bids))
+        else:
+            idx = np.array([self.bid_index[bid] for bid in bids], dtype=np.int64)
+        # the score of each bid (by position in bids) is the product of its memberships,
+        # accumulated in place as a sum of logs so that long queries do not underflow
+        scores = np.zeros(len(bids))
         for qterm in query:
-            qterm = qterm.lower()
-            attr_name, _ = self.interpret(qterm)
-            for bid in bids:
-                scores[bid] *= membership(bid, attr_name, qterm)
-        return sorted(bids, key=lambda x : -scores[x])
+            attr_name, _ = interpretations[qterm]
+            memberships = self.membership_batch(idx, attr_name, qterm, mode=mode)
+            # a zero membership is -inf, which ranks last as a zero product did
+            with np.errstate(divide='ignore'):
+                scores += np.log(memberships)
+        # a stable sort keeps tied bids in their given order
+        return [bids[i] for i in np.argsort(-scores, kind='stable')]
 
 
 if __name__ == '__main__':